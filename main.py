@@ -1,19 +1,64 @@
 import os
-import subprocess
-import sqlite3
+import asyncio
+import hmac
 import logging
 import signal
 import json
+import time
+from collections import deque
+from contextlib import asynccontextmanager
 from datetime import datetime
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Header, Depends, Query
+import aiosqlite
+from fastapi import FastAPI, Header, Query, Response
+from fastapi.responses import JSONResponse
 
 # Configuration from Environment Variables
 DB_PATH = "/app/data/sync.db"
 API_SECRET = os.getenv("API_SECRET")
+API_SECRET_BYTES = API_SECRET.encode() if API_SECRET is not None else None
+# Endpoints that require a matching x-api-key header
+PROTECTED_PATHS = {"/sync", "/cancel", "/status"}
 # Ensure these match your Railway variable names for consistency
 SOURCE_REMOTE = os.getenv("DROPBOX_SOURCE_PATH", "dropbox:sessions") 
 DEST_REMOTE = os.getenv("WASABI_DEST_PATH", "wasabi:systemconcepts-sessions")
 
+# rclone parallelism; buffers can take up to
+# transfers x (s3 upload concurrency x s3 chunk size + buffer size) of memory
+RCLONE_TRANSFERS = os.getenv("RCLONE_TRANSFERS", "16")
+RCLONE_CHECKERS = os.getenv("RCLONE_CHECKERS", "32")
+RCLONE_MULTI_THREAD_STREAMS = os.getenv("RCLONE_MULTI_THREAD_STREAMS", "4")
+RCLONE_MULTI_THREAD_CUTOFF = os.getenv("RCLONE_MULTI_THREAD_CUTOFF", "32M")
+RCLONE_S3_UPLOAD_CONCURRENCY = os.getenv("RCLONE_S3_UPLOAD_CONCURRENCY", "4")
+RCLONE_S3_CHUNK_SIZE = os.getenv("RCLONE_S3_CHUNK_SIZE", "16M")
+RCLONE_BUFFER_SIZE = os.getenv("RCLONE_BUFFER_SIZE", "16M")
+# List the destination once (--fast-list) unless only a handful of files are
+# expected to change, in which case per-file lookups (--no-traverse) are cheaper.
+# --update then compares against the S3 upload time (--use-server-modtime),
+# since reading the stored mtime would cost a HEAD request per object
+RCLONE_NO_TRAVERSE = os.getenv("RCLONE_NO_TRAVERSE", "").lower() in ("1", "true", "yes")
+# By default rclone only reports stats and notices/errors; VERBOSE brings back
+# a line per transferred file for debugging
+VERBOSE = os.getenv("VERBOSE", "").lower() in ("1", "true", "yes")
+
+# rclone output is queued and written by a background task in batches
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 100
+# Seconds to wait for queued log lines to be written on shutdown
+LOG_DRAIN_TIMEOUT = 5
+# Longest single line accepted from rclone (JSON stats lines can be long)
+STREAM_LINE_LIMIT = 1 << 20
+
+# rclone stats ticks are kept in memory and persisted at most this often
+STATS_LOG_INTERVAL = 30  # seconds
+# Number of most recent log lines returned by /status
+LOG_TAIL_LINES = 200
+# Characters of jobs.logs shown for jobs logged before job_log_lines existed
+LEGACY_LOG_CHARS = 2000
+# Jobs kept in the database; older jobs and their logs are pruned after each sync
+JOB_RETENTION = 100
+# Free pages returned to the filesystem per incremental vacuum
+VACUUM_PAGES = 1000
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("sync-worker")
@@ -22,72 +67,346 @@ app = FastAPI()
 
 # Global variable to track the active process for cancellation
 active_process = None
+# Task running the current sync (kept referenced so it isn't garbage collected)
+_sync_task = None
+# Serializes the "is a job running?" check with starting a new job
+_sync_lock = asyncio.Lock()
 
-def get_db():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+# Connection pool: a single serialized writer plus a queue of readers
+# (each aiosqlite connection owns a thread, so the reader count stays small)
+READ_POOL_SIZE = min(4, os.cpu_count() or 1)
+_write_conn = None
+_write_lock = asyncio.Lock()
+_read_pool = asyncio.Queue()
+
+# Pending (job_id, ts, line) rows waiting for the log writer task
+_log_q = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_writer_task = None
+
+# In-memory copy of the running job and its recent (ts, line) log tail;
+# SQLite stays the durable record and is consulted once no job is running.
+# Only touched from the event loop, so no lock is needed
+_current = None
+_current_tail = deque(maxlen=LOG_TAIL_LINES)
+# Latest structured stats reported by rclone for the running job
+_current_stats = None
+# Bumped on every change to the state above and used as the /status ETag;
+# the epoch keeps tags from a previous process from matching after a restart
+_status_epoch = f"{int(time.time()):x}"
+_status_version = 0
+
+def touch_status():
+    global _status_version
+    _status_version += 1
+
+async def open_db(**kwargs):
+    conn = await aiosqlite.connect(DB_PATH, **kwargs)
+    conn.row_factory = aiosqlite.Row
+    # WAL lets /status readers run alongside the log writer, and NORMAL sync
+    # avoids an fsync on every commit (still durable across app crashes)
+    await conn.execute("PRAGMA journal_mode=WAL;")
+    await conn.execute("PRAGMA synchronous=NORMAL;")
+    await conn.execute("PRAGMA busy_timeout=5000;")
+    await conn.execute("PRAGMA temp_store=MEMORY;")
+    await conn.execute("PRAGMA cache_size=-20000;")
     return conn
 
-def init_db():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS jobs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, 
-            start_time TEXT, 
-            end_time TEXT, 
-            status TEXT, 
-            logs TEXT
-        )
-    ''')
-    # Clear orphaned jobs from previous crashes/restarts
-    c.execute('''
-        UPDATE jobs 
-        SET status = 'FAILED', 
-            logs = logs || '\n' || ? || ': [SYSTEM] Sync was interrupted by a server restart.',
-            end_time = ?
-        WHERE status = 'RUNNING'
-    ''', (datetime.now().strftime('%H:%M:%S'), datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+async def init_pool():
+    global _write_conn
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    # Transactions on the writer are managed explicitly in get_writer()
+    _write_conn = await open_db(isolation_level=None)
+    for _ in range(READ_POOL_SIZE):
+        _read_pool.put_nowait(await open_db())
+
+async def close_pool():
+    await _write_conn.close()
+    while not _read_pool.empty():
+        await _read_pool.get_nowait().close()
+
+@asynccontextmanager
+async def get_writer():
+    """Borrow the shared writer connection inside a BEGIN IMMEDIATE transaction."""
+    async with _write_lock:
+        # Taking the write lock up front avoids SQLITE_BUSY on a later upgrade
+        await _write_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _write_conn
+            await _write_conn.execute("COMMIT")
+        except Exception:
+            await _write_conn.execute("ROLLBACK")
+            raise
+
+@asynccontextmanager
+async def get_reader():
+    """Borrow a read-only connection from the pool."""
+    conn = await _read_pool.get()
+    try:
+        yield conn
+    finally:
+        _read_pool.put_nowait(conn)
+
+async def vacuum_free_pages():
+    """Release up to VACUUM_PAGES free pages back to the filesystem."""
+    async with _write_lock:
+        # executescript steps the pragma to completion (execute frees one page)
+        await _write_conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+
+async def init_db():
+    await init_pool()
+    async with _write_lock:
+        async with _write_conn.execute("PRAGMA auto_vacuum") as cursor:
+            auto_vacuum = (await cursor.fetchone())[0]
+        if auto_vacuum != 2:
+            # Switching an existing database to incremental mode needs a full VACUUM once
+            await _write_conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await _write_conn.execute("VACUUM")
+    async with get_writer() as c:
+        await c.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                start_time TEXT, 
+                end_time TEXT, 
+                status TEXT, 
+                logs TEXT
+            )
+        ''')
+        await c.execute('''
+            CREATE TABLE IF NOT EXISTS job_log_lines (
+                id INTEGER PRIMARY KEY,
+                job_id INTEGER,
+                ts REAL,
+                line TEXT
+            )
+        ''')
+        await c.execute("CREATE INDEX IF NOT EXISTS idx_job_log_lines_job ON job_log_lines(job_id, id)")
+        await c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs(status) WHERE status = 'RUNNING'")
+        # Clear orphaned jobs from previous crashes/restarts
+        await c.execute('''
+            INSERT INTO job_log_lines (job_id, ts, line)
+            SELECT id, ?, '[SYSTEM] Sync was interrupted by a server restart.'
+            FROM jobs WHERE status = 'RUNNING'
+        ''', (time.time(),))
+        await c.execute('''
+            UPDATE jobs 
+            SET status = 'FAILED', 
+                end_time = ?
+            WHERE status = 'RUNNING'
+        ''', (datetime.now().isoformat(),))
+    await vacuum_free_pages()
     logger.info("Database initialized.")
 
-def log_job_start():
-    conn = get_db()
-    c = conn.cursor()
-    initial_log = f"🚀 Job Started: {SOURCE_REMOTE} -> {DEST_REMOTE}\n"
-    c.execute(
-        "INSERT INTO jobs (start_time, status, logs) VALUES (?, ?, ?)", 
-        (datetime.now().isoformat(), 'RUNNING', initial_log)
-    )
-    job_id = c.lastrowid
-    conn.commit()
-    conn.close()
+async def prune_jobs():
+    """Delete jobs older than the newest JOB_RETENTION, along with their log lines."""
+    async with get_writer() as conn:
+        async with conn.execute(
+            "SELECT id FROM jobs ORDER BY id DESC LIMIT 1 OFFSET ?", (JOB_RETENTION - 1,)
+        ) as cursor:
+            oldest_kept = await cursor.fetchone()
+        if not oldest_kept:
+            return
+        await conn.execute("DELETE FROM job_log_lines WHERE job_id < ?", (oldest_kept['id'],))
+        await conn.execute("DELETE FROM jobs WHERE id < ?", (oldest_kept['id'],))
+    await vacuum_free_pages()
+
+async def log_job_start():
+    global _current, _current_stats
+    initial_log = f"🚀 Job Started: {SOURCE_REMOTE} -> {DEST_REMOTE}"
+    start_time = datetime.now().isoformat()
+    ts = time.time()
+    async with get_writer() as conn:
+        c = await conn.execute(
+            "INSERT INTO jobs (start_time, status) VALUES (?, ?)", 
+            (start_time, 'RUNNING')
+        )
+        job_id = c.lastrowid
+        await conn.execute(
+            "INSERT INTO job_log_lines (job_id, ts, line) VALUES (?, ?, ?)",
+            (job_id, ts, initial_log)
+        )
+    _current = {"id": job_id, "start_time": start_time, "end_time": None, "status": "RUNNING"}
+    _current_tail.clear()
+    _current_tail.append((ts, initial_log))
+    _current_stats = None
+    touch_status()
     return job_id
 
-def log_job_update(job_id, new_log_line=None, status=None):
-    conn = get_db()
-    c = conn.cursor()
+async def log_job_update(job_id, new_log_line=None, status=None):
+    global _current
+    # Let queued lines land first so the log order matches the output order
+    await _log_q.join()
     updates = []
     params = []
-    if new_log_line:
-        updates.append("logs = logs || ?")
-        params.append(f"{datetime.now().strftime('%H:%M:%S')}: {new_log_line}\n")
+    ts = time.time()
+    finished = status in ['COMPLETED', 'FAILED', 'CANCELLED']
     if status:
         updates.append("status = ?")
         params.append(status)
-        if status in ['COMPLETED', 'FAILED', 'CANCELLED']:
+        if finished:
             updates.append("end_time = ?")
             params.append(datetime.now().isoformat())
-    if updates:
-        params.append(job_id)
-        query = f"UPDATE jobs SET {', '.join(updates)} WHERE id = ?"
-        c.execute(query, params)
-        conn.commit()
-    conn.close()
-
-def run_rclone_sync(job_id, dynamic_token: str = None):
+    if not new_log_line and not updates:
+        return
+    async with get_writer() as conn:
+        if new_log_line:
+            await conn.execute(
+                "INSERT INTO job_log_lines (job_id, ts, line) VALUES (?, ?, ?)",
+                (job_id, ts, new_log_line)
+            )
+        if updates:
+            params.append(job_id)
+            await conn.execute(f"UPDATE jobs SET {', '.join(updates)} WHERE id = ?", params)
+    if not _current or _current["id"] != job_id:
+        return
+    touch_status()
+    if new_log_line:
+        _current_tail.append((ts, new_log_line))
+    if finished:
+        _current = None
+    elif status:
+        _current["status"] = status
+
+async def log_job_lines(rows):
+    """Insert a batch of (job_id, ts, line) rows in a single transaction."""
+    if not rows:
+        return
+    async with get_writer() as conn:
+        await conn.executemany("INSERT INTO job_log_lines (job_id, ts, line) VALUES (?, ?, ?)", rows)
+
+def queue_log_line(job_id, line):
+    """Hand a log line to the writer task, dropping the oldest one when full."""
+    row = (job_id, time.time(), line)
+    if _current and _current["id"] == job_id:
+        _current_tail.append(row[1:])
+        touch_status()
+    try:
+        _log_q.put_nowait(row)
+    except asyncio.QueueFull:
+        try:
+            _log_q.get_nowait()
+            _log_q.task_done()
+        except asyncio.QueueEmpty:
+            pass
+        _log_q.put_nowait(row)
+
+async def log_writer():
+    """Drain the log queue, writing up to LOG_BATCH_SIZE rows per transaction."""
+    while True:
+        batch = [await _log_q.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_log_q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            await log_job_lines(batch)
+        except Exception as e:
+            logger.error(f"Log Writer Error: {str(e)}")
+        finally:
+            for _ in batch:
+                _log_q.task_done()
+
+def format_log_lines(rows):
+    """Render (ts, line) rows the way they are shown in /status."""
+    out = []
+    last_second = None
+    for ts, line in rows:
+        # Most lines share their second with the previous one
+        second = int(ts)
+        if second != last_second:
+            stamp = time.strftime('%H:%M:%S', time.localtime(second))
+            last_second = second
+        out.append(f"{stamp}: {line}\n")
+    return "".join(out)
+
+async def get_job_logs(conn, job_id, limit=LOG_TAIL_LINES):
+    """Return the last `limit` log lines of a job as a single string."""
+    rows = await conn.execute_fetchall(
+        "SELECT ts, line FROM job_log_lines WHERE job_id = ? ORDER BY id DESC LIMIT ?",
+        (job_id, limit)
+    )
+    logs = format_log_lines(reversed(rows))
+    if len(rows) < limit:
+        # Jobs from before the upgrade kept their log in jobs.logs (NULL for newer jobs)
+        async with conn.execute(
+            "SELECT substr(logs, -?) AS logs FROM jobs WHERE id = ?", (LEGACY_LOG_CHARS, job_id)
+        ) as cursor:
+            legacy = await cursor.fetchone()
+        if legacy and legacy['logs']:
+            logs = legacy['logs'].rstrip("\n") + "\n" + logs
+    return logs
+
+def set_current_stats(job_id, stats):
+    global _current_stats
+    if _current and _current["id"] == job_id:
+        _current_stats = stats
+        touch_status()
+
+def parse_size(value):
+    """Parse an rclone size such as '16M' into bytes (no suffix means KiB)."""
+    value = value.strip().upper().removesuffix("IB").removesuffix("I")
+    units = {"B": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40, "P": 1 << 50}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value) * units["K"])
+
+def memory_limit():
+    """Return the container's memory limit, or physical memory when unlimited."""
+    total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v2 reports "max" and v1 a huge number when there is no limit
+        if value.isdigit():
+            return min(int(value), total)
+        break
+    return total
+
+def check_rclone_memory():
+    """Warn when rclone's worst-case buffer usage exceeds the container's memory."""
+    try:
+        per_transfer = (
+            int(RCLONE_S3_UPLOAD_CONCURRENCY) * parse_size(RCLONE_S3_CHUNK_SIZE)
+            + parse_size(RCLONE_BUFFER_SIZE)
+        )
+        estimate = int(RCLONE_TRANSFERS) * per_transfer
+    except ValueError as e:
+        logger.warning(f"Skipping rclone memory estimate: {str(e)}")
+        return
+    total = memory_limit()
+    if estimate > total:
+        logger.warning(f"rclone buffers may need {format_size(estimate)}, more than the {format_size(total)} available")
+    else:
+        logger.info(f"rclone buffers may use up to {format_size(estimate)}")
+
+def format_size(num):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num) < 1024:
+            return f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} TiB"
+
+def format_stats(stats):
+    """Summarize an rclone stats object as a single log line."""
+    eta = stats.get("eta")
+    return (
+        f"Transferred: {format_size(stats.get('bytes', 0))} / {format_size(stats.get('totalBytes', 0))}, "
+        f"{stats.get('transfers', 0)} / {stats.get('totalTransfers', 0)} files, "
+        f"{stats.get('errors', 0)} errors, {format_size(stats.get('speed', 0))}/s, "
+        f"ETA {f'{eta}s' if eta is not None else '-'}"
+    )
+
+def format_log_entry(entry):
+    """Render a --use-json-log entry like rclone's plain text output."""
+    msg = entry.get("msg", "").strip()
+    if entry.get("object"):
+        msg = f"{entry['object']}: {msg}"
+    return f"{entry.get('level', 'info').upper()}: {msg}"
+
+async def run_rclone_sync(job_id, dynamic_token: str = None):
     """Execute rclone using an optional short-lived token from Vercel."""
     global active_process
     
@@ -105,93 +424,183 @@ def run_rclone_sync(job_id, dynamic_token: str = None):
         env["RCLONE_CONFIG_DROPBOX_TOKEN"] = token_blob
         logger.info("Syncing with dynamic token from Vercel...")
 
+    # rclone is spawned per job rather than driven through a long-lived
+    # `rclone rcd` daemon: the Dropbox token can change with every request
+    # and is handed over through this process's environment
     cmd = [
         "rclone", "copy", SOURCE_REMOTE, DEST_REMOTE,
         "--update",
-        "--transfers", "4",
-        "--verbose",
+        "--use-server-modtime",
+        "--size-only",
+        "--transfers", RCLONE_TRANSFERS,
+        "--checkers", RCLONE_CHECKERS,
+        "--multi-thread-streams", RCLONE_MULTI_THREAD_STREAMS,
+        "--multi-thread-cutoff", RCLONE_MULTI_THREAD_CUTOFF,
+        "--s3-upload-concurrency", RCLONE_S3_UPLOAD_CONCURRENCY,
+        "--s3-chunk-size", RCLONE_S3_CHUNK_SIZE,
+        "--buffer-size", RCLONE_BUFFER_SIZE,
+        *(["--verbose"] if VERBOSE else ["--log-level", "NOTICE"]),
         "--stats", "2s",
+        "--stats-one-line",
+        "--stats-log-level", "NOTICE",
+        "--use-json-log",
         "--ignore-checksum",
         "--no-update-modtime",
-        "--no-traverse"
+        "--no-traverse" if RCLONE_NO_TRAVERSE else "--fast-list"
     ]
     
     try:
-        active_process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT, 
-            text=True, 
-            bufsize=1,
+        active_process = await asyncio.create_subprocess_exec(
+            *cmd, 
+            stdout=asyncio.subprocess.PIPE, 
+            stderr=asyncio.subprocess.STDOUT, 
             start_new_session=True,
-            env=env
+            env=env,
+            limit=STREAM_LINE_LIMIT
         )
         
-        for line in active_process.stdout:
-            clean_line = line.strip()
+        # Stats ticks supersede each other, so the latest one is kept in
+        # memory and only logged every STATS_LOG_INTERVAL seconds
+        stats = None
+        stats_logged_at = time.monotonic()
+        async for raw in active_process.stdout:
+            clean_line = raw.decode("utf-8", "replace").strip()
+            if not clean_line:
+                continue
             print(clean_line)
-            log_job_update(job_id, new_log_line=clean_line)
+            try:
+                entry = json.loads(clean_line)
+            except ValueError:
+                entry = None
+            if not isinstance(entry, dict):
+                queue_log_line(job_id, clean_line)
+                continue
+            if "stats" in entry:
+                stats = entry["stats"]
+                set_current_stats(job_id, stats)
+                if time.monotonic() - stats_logged_at >= STATS_LOG_INTERVAL:
+                    queue_log_line(job_id, format_stats(stats))
+                    stats_logged_at = time.monotonic()
+                continue
+            queue_log_line(job_id, format_log_entry(entry))
+        # The final stats tick doubles as the job summary
+        if stats:
+            queue_log_line(job_id, format_stats(stats))
             
-        active_process.wait()
+        await active_process.wait()
         
         status_map = {0: "COMPLETED", -15: "CANCELLED"} # -15 is SIGTERM
         final_status = status_map.get(active_process.returncode, "FAILED")
             
-        log_job_update(job_id, new_log_line=f"Exit code: {active_process.returncode}", status=final_status)
+        await log_job_update(job_id, new_log_line=f"Exit code: {active_process.returncode}", status=final_status)
         
     except Exception as e:
         logger.error(f"Execution Error: {str(e)}")
-        log_job_update(job_id, new_log_line=f"CRITICAL ERROR: {str(e)}", status="FAILED")
+        await log_job_update(job_id, new_log_line=f"CRITICAL ERROR: {str(e)}", status="FAILED")
     finally:
         active_process = None
 
-async def verify_secret(x_api_key: str = Header(None)):
-    if x_api_key != API_SECRET:
-        raise HTTPException(status_code=401, detail="Invalid Secret")
+    try:
+        await prune_jobs()
+    except Exception as e:
+        logger.error(f"Retention Error: {str(e)}")
+
+def is_valid_api_key(key):
+    if API_SECRET_BYTES is None:
+        # Without a configured secret only requests that send no key match
+        return key is None
+    return key is not None and hmac.compare_digest(key, API_SECRET_BYTES)
+
+class APIKeyMiddleware:
+    """Reject requests to protected paths before they reach the router."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in PROTECTED_PATHS:
+            key = next((value for name, value in scope["headers"] if name == b"x-api-key"), None)
+            if not is_valid_api_key(key):
+                response = JSONResponse({"detail": "Invalid Secret"}, status_code=401)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+app.add_middleware(APIKeyMiddleware)
 
 @app.on_event("startup")
-def on_startup():
-    init_db()
+async def on_startup():
+    global _log_writer_task
+    await init_db()
+    check_rclone_memory()
+    _log_writer_task = asyncio.create_task(log_writer())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    try:
+        await asyncio.wait_for(_log_q.join(), LOG_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Dropped {_log_q.qsize()} queued log lines on shutdown")
+    _log_writer_task.cancel()
+    await close_pool()
 
 @app.get("/")
 def health():
     return {"status": "online", "timestamp": datetime.now().isoformat()}
 
-@app.post("/sync", dependencies=[Depends(verify_secret)])
-async def trigger_sync(background_tasks: BackgroundTasks, x_db_token: str = Header(None)):
+@app.post("/sync")
+async def trigger_sync(x_db_token: str = Header(None)):
     """Trigger a sync, optionally passing the Dropbox access token in x-db-token header."""
-    conn = get_db()
-    active = conn.execute("SELECT id FROM jobs WHERE status = 'RUNNING'").fetchone()
-    conn.close()
-    
-    if active:
-        return {"status": "ignored", "message": "A sync job is already in progress.", "job_id": active['id']}
-    
-    job_id = log_job_start()
-    background_tasks.add_task(run_rclone_sync, job_id, x_db_token)
+    global _sync_task
+    async with _sync_lock:
+        active = _current
+        if not active:
+            async with get_reader() as conn:
+                async with conn.execute("SELECT id FROM jobs WHERE status = 'RUNNING'") as cursor:
+                    active = await cursor.fetchone()
+        
+        if active:
+            return {"status": "ignored", "message": "A sync job is already in progress.", "job_id": active['id']}
+        
+        job_id = await log_job_start()
+    _sync_task = asyncio.create_task(run_rclone_sync(job_id, x_db_token))
     return {"status": "started", "job_id": job_id}
 
-@app.post("/cancel", dependencies=[Depends(verify_secret)])
+@app.post("/cancel")
 async def cancel_sync():
-    global active_process
-    if not active_process:
+    process = active_process
+    # A set returncode means the process was already reaped and its pid may be reused
+    if not process or process.returncode is not None:
         return {"status": "ignored", "message": "No active sync to cancel."}
     try:
-        os.killpg(os.getpgid(active_process.pid), signal.SIGTERM)
+        # start_new_session makes rclone its own process group leader
+        os.killpg(process.pid, signal.SIGTERM)
         return {"status": "success", "message": "Cancellation signal sent."}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-@app.get("/status", dependencies=[Depends(verify_secret)])
-def get_status(history: bool = Query(False)):
-    conn = get_db()
-    if history:
-        jobs = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT 20").fetchall()
-        conn.close()
-        return [dict(j) for j in jobs]
-    job = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT 1").fetchone()
-    conn.close()
-    return dict(job) if job else {"status": "IDLE"}
+@app.get("/status")
+async def get_status(response: Response, history: bool = Query(False), if_none_match: str = Header(None)):
+    if not history:
+        etag = f'W/"{_status_epoch}-{_status_version}"'
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
+    if not history and _current:
+        return {**_current, "logs": format_log_lines(_current_tail), "stats": _current_stats}
+    async with get_reader() as conn:
+        if history:
+            jobs = await conn.execute_fetchall(
+                "SELECT id, start_time, end_time, status FROM jobs ORDER BY id DESC LIMIT 20"
+            )
+            return [dict(j) for j in jobs]
+        async with conn.execute(
+            "SELECT id, start_time, end_time, status FROM jobs ORDER BY id DESC LIMIT 1"
+        ) as cursor:
+            job = await cursor.fetchone()
+        if not job:
+            return {"status": "IDLE"}
+        return {**dict(job), "logs": await get_job_logs(conn, job['id'])}
 
 if __name__ == "__main__":
     import uvicorn